@@ -1,3 +1,4 @@
 from toydb.db import ToyDB, ToyDBException, ToyDBType
+from toydb.sharded import ShardedToyDB
 
-__all__ = ("ToyDB", "ToyDBException", "ToyDBType")
+__all__ = ("ShardedToyDB", "ToyDB", "ToyDBException", "ToyDBType")
@@ -0,0 +1,8 @@
+from collections.abc import Buffer, Iterable
+
+def bloom_add(bits: bytearray, m: int, k: int, h1: int, h2: int) -> None: ...
+def bloom_add_many(bits: bytearray, m: int, k: int, keys: Iterable[bytes]) -> None: ...
+def bloom_contains(bits: bytearray, m: int, k: int, h1: int, h2: int) -> bool: ...
+def parse_buffer(
+    buffer: Buffer, offset: int
+) -> list[tuple[bytes, bytes | None, int]]: ...
@@ -0,0 +1,141 @@
+# cython: language_level=3, boundscheck=False, wraparound=False
+"""Compiled versions of the hottest loops of ToyDB.
+
+Building this is optional, ToyDB falls back to its pure Python implementations if
+it isn't available. Both have to behave exactly the same, Bloom filters in
+particular are persisted and have to stay readable either way."""
+
+from hashlib import blake2b
+
+from cpython.bytes cimport PyBytes_FromStringAndSize
+from libc.stdint cimport uint64_t
+
+
+cdef enum:
+    KEY = 0
+    VALUE = 1
+    TOMBSTONE = 2
+
+
+cdef void _set_bits(
+    unsigned char *bits, uint64_t m, int k, uint64_t h1, uint64_t h2
+) noexcept nogil:
+    cdef int i
+    cdef uint64_t position
+    for i in range(k):
+        position = (h1 + i * h2) % m
+        bits[position >> 3] |= 1 << (position & 7)
+
+
+cdef inline uint64_t _little_endian_64(const unsigned char *p) noexcept nogil:
+    cdef uint64_t n = 0
+    cdef int i
+    for i in range(7, -1, -1):
+        n = n << 8 | p[i]
+    return n
+
+
+def bloom_add(unsigned char[::1] bits, uint64_t m, int k, uint64_t h1, uint64_t h2):
+    """Set the k bits of a key given its two hashes."""
+    with nogil:
+        _set_bits(&bits[0], m, k, h1, h2)
+
+
+def bloom_add_many(unsigned char[::1] bits, uint64_t m, int k, keys):
+    """Set the k bits of each of the keys, hashing them like `_two_hashes`."""
+    cdef bytes digest
+    cdef const unsigned char *hashes
+    for key in keys:
+        digest = blake2b(key, digest_size=16).digest()
+        hashes = <const unsigned char *>digest
+        _set_bits(
+            &bits[0], m, k, _little_endian_64(hashes), _little_endian_64(hashes + 8)
+        )
+
+
+def bloom_contains(
+    const unsigned char[::1] bits, uint64_t m, int k, uint64_t h1, uint64_t h2
+):
+    """Whether all k bits of a key given its two hashes are set."""
+    cdef int i
+    cdef uint64_t position
+    cdef bint found = True
+    with nogil:
+        for i in range(k):
+            position = (h1 + i * h2) % m
+            if not bits[position >> 3] & (1 << (position & 7)):
+                found = False
+                break
+    return found
+
+
+cdef int _corrupt(str message) except -1:
+    from toydb.db import ToyDBException
+
+    raise ToyDBException(message)
+
+
+cdef Py_ssize_t _read_length(
+    const unsigned char[::1] buffer, Py_ssize_t *offset
+) except -1:
+    """Decode the varint at the offset and advance the offset past it."""
+    cdef Py_ssize_t size = buffer.shape[0]
+    cdef Py_ssize_t length = 0
+    cdef int shift = 0
+    cdef unsigned char byte
+    while True:
+        if offset[0] >= size or shift > 56:
+            _corrupt("Corrupt DB, unexpected end of data.")
+        byte = buffer[offset[0]]
+        offset[0] += 1
+        length |= <Py_ssize_t>(byte & 0x7F) << shift
+        if byte < 0x80:
+            break
+        shift += 7
+    if length > size - offset[0]:
+        _corrupt("Corrupt DB, unexpected end of data.")
+    return length
+
+
+cdef bytes _read_payload(
+    const unsigned char[::1] buffer, Py_ssize_t offset, Py_ssize_t length
+):
+    if length == 0:
+        return b""
+    return PyBytes_FromStringAndSize(<const char *>&buffer[offset], length)
+
+
+def parse_buffer(const unsigned char[::1] buffer, Py_ssize_t offset):
+    """Parse the records of a data file's contents from the offset on.
+
+    Returns the key, the value (None for tombstones) and the offset each record ends
+    at."""
+    cdef Py_ssize_t size = buffer.shape[0]
+    cdef Py_ssize_t length
+    cdef unsigned char type_
+    records = []
+    while offset < size:
+        type_ = buffer[offset]
+        offset += 1
+        length = _read_length(buffer, &offset)
+        key = _read_payload(buffer, offset, length)
+        offset += length
+        if type_ == KEY:
+            if offset >= size:
+                _corrupt("Corrupt DB, unexpected end of data.")
+            if buffer[offset] != VALUE:
+                _corrupt(
+                    f"Corrupt DB, type '{VALUE}' expected after type '{KEY}'."
+                )
+            offset += 1
+            length = _read_length(buffer, &offset)
+            value = _read_payload(buffer, offset, length)
+            offset += length
+        elif type_ == TOMBSTONE:
+            value = None
+        elif type_ == VALUE:
+            _corrupt(f"Corrupt DB, type '{VALUE}' without prior type '{KEY}'.")
+        else:
+            _corrupt(f"Corrupt DB, unknown type '{type_}'.")
+        records.append((key, value, offset))
+    return records
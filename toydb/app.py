@@ -1,14 +1,27 @@
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, cast
+
 from fastapi import FastAPI, Depends
 from pydantic import BaseModel
 
 from toydb import ToyDB
 from toydb._utils import dirs
 
-app = FastAPI()
+
+@asynccontextmanager
+async def lifespan(app: FastAPI) -> AsyncIterator[None]:
+    # Share one instance across requests so the data files are only scanned once
+    # and the in-memory cache survives between requests.
+    app.state.db = ToyDB(dirs.user_data_dir)
+    yield
+    await app.state.db.close()
+
+
+app = FastAPI(lifespan=lifespan)
 
 
 async def get_db() -> ToyDB:
-    return ToyDB(dirs.user_data_dir)
+    return cast(ToyDB, app.state.db)
 
 
 class GetValueResponse(BaseModel):
@@ -0,0 +1,88 @@
+"""Bloom filter implementation."""
+
+import hashlib
+import math
+import struct
+from typing import Iterable, Self
+
+try:
+    from toydb import _fast
+except ImportError:
+    _fast = None  # type: ignore[assignment]
+
+# Number of bits, number of hash functions
+_HEADER = struct.Struct("!IB")
+
+
+def _two_hashes(key: bytes) -> tuple[int, int]:
+    """Derive two independent 64 bit hashes of the key from a single digest."""
+    digest = hashlib.blake2b(key, digest_size=16).digest()
+    return int.from_bytes(digest[:8], "little"), int.from_bytes(digest[8:], "little")
+
+
+class BloomFilter:
+    """Probabilistic set of keys without false negatives.
+
+    The k bit positions of a key are derived from the two halves of a single BLAKE2
+    digest by double hashing, i.e. the i-th position is h1 + i * h2."""
+
+    __slots__ = ("bits", "m", "k")
+
+    def __init__(self, m: int, k: int, bits: bytearray | None = None):
+        """Initialize an empty Bloom filter or one backed by the given bits.
+
+        :param m: The number of bits.
+        :param k: The number of hash functions."""
+        self.m = m
+        self.k = k
+        self.bits = bits if bits is not None else bytearray((m + 7) // 8)
+
+    @classmethod
+    def for_capacity(cls, n: int, false_positive_rate: float = 0.01) -> Self:
+        """Create a Bloom filter sized for n keys at the given false positive rate."""
+        n = max(n, 1)
+        m = math.ceil(-n * math.log(false_positive_rate) / math.log(2) ** 2)
+        k = max(1, round(m / n * math.log(2)))
+        return cls(m, k)
+
+    def _positions(self, key: bytes) -> list[int]:
+        h1, h2 = _two_hashes(key)
+        # Wraps around like the unsigned 64 bit arithmetic of the compiled version
+        return [((h1 + i * h2) & 0xFFFFFFFFFFFFFFFF) % self.m for i in range(self.k)]
+
+    def add(self, key: bytes) -> None:
+        """Add the key to the filter."""
+        if _fast is not None:
+            _fast.bloom_add(self.bits, self.m, self.k, *_two_hashes(key))
+            return
+        for position in self._positions(key):
+            self.bits[position >> 3] |= 1 << (position & 7)
+
+    def add_many(self, keys: Iterable[bytes]) -> None:
+        """Add all of the keys to the filter, faster than adding them one by one."""
+        if _fast is not None:
+            _fast.bloom_add_many(self.bits, self.m, self.k, keys)
+            return
+        bits = self.bits
+        for key in keys:
+            for position in self._positions(key):
+                bits[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, key: bytes) -> bool:
+        """Whether the key might have been added to the filter."""
+        if _fast is not None:
+            return _fast.bloom_contains(self.bits, self.m, self.k, *_two_hashes(key))
+        return all(
+            self.bits[position >> 3] & (1 << (position & 7))
+            for position in self._positions(key)
+        )
+
+    def serialize(self) -> bytes:
+        """Serialize this filter to bytes."""
+        return _HEADER.pack(self.m, self.k) + self.bits
+
+    @classmethod
+    def deserialize(cls, data: bytes) -> Self:
+        """Deserialize a filter previously serialized with `serialize`."""
+        m, k = _HEADER.unpack_from(data)
+        return cls(m, k, bytearray(data[_HEADER.size :]))
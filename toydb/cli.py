@@ -1,39 +1,71 @@
-from urllib.parse import urljoin
+import atexit
+import contextlib
+import functools
+import sys
+from typing import TYPE_CHECKING, Any, ContextManager
 
 import httpx
 import typer
-from rich.console import Console
-from rich.prompt import Confirm
+
+if TYPE_CHECKING:
+    from rich.console import Console
+    from rich.status import Status
 
 
 app = typer.Typer(no_args_is_help=True)
 state = {}
-console = Console()
+# Rich output is only worth its startup cost when a human is watching.
+INTERACTIVE = sys.stdout.isatty()
+
+
+@functools.cache
+def get_console() -> "Console":
+    """Get the rich console, rich is only imported on first use."""
+    from rich.console import Console
+
+    return Console()
+
+
+def echo(message: Any) -> None:
+    """Print the message, using rich when running interactively."""
+    if INTERACTIVE:
+        get_console().print(message)
+    else:
+        print(message)
+
+
+def status(message: str) -> ContextManager["Status | None"]:
+    """Show a spinner with the message while running interactively."""
+    if INTERACTIVE:
+        return get_console().status(message)
+    return contextlib.nullcontext()
 
 
 @app.callback()
 def main(url: str = typer.Option(envvar="TOYDB_URL")):
     """Interact with ToyDB!"""
     state["url"] = url
+    # Share one client, and with it the connection pool, across all requests.
+    state["client"] = httpx.Client(base_url=url)
+    atexit.register(state["client"].close)
 
 
 @app.command()
 def get(key: str):
     """Get the value behind the key from the DB."""
-    with console.status(f"[bold green]Getting key '{key}'..."):
-        endpoint = urljoin(state["url"], f"v1/db/{key}")
+    with status(f"[bold green]Getting key '{key}'..."):
         try:
-            result = httpx.get(endpoint)
+            result = state["client"].get(f"v1/db/{key}")
         except httpx.ConnectError as error:
-            console.print(error)
+            echo(error)
             return 1
         if result.is_success:
-            console.print(result.json())
+            echo(result.json())
         elif result.is_client_error:
-            console.print(result.json())
+            echo(result.json())
             return 1
         else:
-            console.print("Unknown server error.")
+            echo("Unknown server error.")
             return 1
         return 0
 
@@ -41,20 +73,19 @@ def get(key: str):
 @app.command(name="set")
 def set_(key: str, value: str) -> int:
     """Set the key to the value."""
-    with console.status(f"[bold green]Setting key '{key}'..."):
-        endpoint = urljoin(state["url"], f"v1/db/{key}")
+    with status(f"[bold green]Setting key '{key}'..."):
         try:
-            result = httpx.post(endpoint, json={"value": value})
+            result = state["client"].post(f"v1/db/{key}", json={"value": value})
         except httpx.ConnectError as error:
-            console.print(error)
+            echo(error)
             return 1
         if result.is_success:
-            console.print(f"Successfully set key '{key}'.")
+            echo(f"Successfully set key '{key}'.")
         elif result.is_client_error:
-            console.print(result.json()["details"])
+            echo(result.json()["details"])
             return 1
         else:
-            console.print("Unknown server error.")
+            echo("Unknown server error.")
             return 1
         return 0
 
@@ -62,20 +93,19 @@ def set_(key: str, value: str) -> int:
 @app.command()
 def delete(key: str) -> int:
     """Delete the given key."""
-    with console.status(f"[bold green]Deleting key '{key}'..."):
-        endpoint = urljoin(state["url"], f"v1/db/{key}")
+    with status(f"[bold green]Deleting key '{key}'..."):
         try:
-            result = httpx.delete(endpoint)
+            result = state["client"].delete(f"v1/db/{key}")
         except httpx.ConnectError as error:
-            console.print(error)
+            echo(error)
             return 1
         if result.is_success:
-            console.print(f"Successfully deleted key '{key}'.")
+            echo(f"Successfully deleted key '{key}'.")
         elif result.is_client_error:
-            console.print(result.json()["details"])
+            echo(result.json()["details"])
             return 1
         else:
-            console.print("Unknown server error.")
+            echo("Unknown server error.")
             return 1
         return 0
 
@@ -84,21 +114,22 @@ def delete(key: str) -> int:
 def drop(force: bool = False) -> int:
     """Drops the database."""
     if not force:
-        if not Confirm.ask("Are you sure?"):
+        from rich.prompt import Confirm
+
+        if not Confirm.ask("Are you sure?", console=get_console()):
             return 1
-    endpoint = urljoin(state["url"], "v1/db")
     try:
-        result = httpx.delete(endpoint)
+        result = state["client"].delete("v1/db")
     except httpx.ConnectError as error:
-        console.print(error)
+        echo(error)
         return 1
     if result.is_success:
-        console.print("Successfully dropped database.")
+        echo("Successfully dropped database.")
     elif result.is_client_error:
-        console.print(result.json()["details"])
+        echo(result.json()["details"])
         return 1
     else:
-        console.print("Unknown server error.")
+        echo("Unknown server error.")
         return 1
     return 0
 
@@ -1,15 +1,27 @@
 """Database implementation."""
 
 import asyncio
-import dataclasses
-import os.path
+import contextlib
+import itertools
+import logging
+import mmap
+import os
 import pathlib
+import struct
 from builtins import str
-from collections import defaultdict
+from collections import OrderedDict
 from enum import IntEnum
-from typing import Generator, Self
+from typing import AsyncGenerator, BinaryIO, Collection, Generator, Iterable, Self
 
-import aiofiles
+from toydb.bloom import BloomFilter
+
+try:
+    from toydb import _fast
+except ImportError:
+    _fast = None  # type: ignore[assignment]
+
+
+_logger = logging.getLogger(__name__)
 
 
 class ToyDBException(Exception):
@@ -18,6 +30,40 @@ class ToyDBException(Exception):
     pass
 
 
+# Seconds after which buffered writes are flushed even if the memtable isn't full
+_FLUSH_INTERVAL = 0.1
+
+# Upper bound for the data files compacted concurrently by `compact_all`
+_MAX_CONCURRENT_COMPACTIONS = 2
+
+# Upper bound for the read-only file descriptors of data files kept open by `get`
+_MAX_OPEN_FDS = 200
+
+# Access pattern hints for the kernel aren't available on every platform
+_HAS_FADVISE = hasattr(os, "posix_fadvise")
+_HAS_MADVISE = hasattr(mmap, "MADV_SEQUENTIAL")
+# Neither are reads that fail instead of blocking on the disk
+_HAS_RWF_NOWAIT = hasattr(os, "RWF_NOWAIT")
+
+# Data files smaller than this are read rather than mapped, for them setting up the
+# mapping costs more than copying their contents.
+_MMAP_THRESHOLD = 4096
+
+# Every data file starts with the version of its format, older formats are migrated
+# on startup. Data files from before the format was versioned start with a key or
+# tombstone type, which is why the version can't be either of those.
+_FORMAT_VERSION = 3
+# Lengths were unsigned 16 bit integers instead of varints
+_FORMAT_VERSION_UINT16 = 1
+_FILE_HEADER = bytes((_FORMAT_VERSION,))
+
+# Default for the maximum size of a single data file
+DEFAULT_MAX_FILE_SIZE = 4 * 1024 * 1024
+
+# Size of the data file a persisted Bloom filter was built from
+_BLOOM_HEADER = struct.Struct("!Q")
+
+
 class ToyDBType(IntEnum):
     """Types for the type-length-value encoding of ToyDB."""
 
@@ -26,99 +72,412 @@ class ToyDBType(IntEnum):
     TOMBSTONE = 2
 
 
-@dataclasses.dataclass
+# Plain int values of the types for the parser, comparing against those skips the
+# attribute lookup on the enum and its comparison.
+_KEY = int(ToyDBType.KEY)
+_VALUE = int(ToyDBType.VALUE)
+_TOMBSTONE = int(ToyDBType.TOMBSTONE)
+
+# Each field of a record starts with its type followed by the length of its payload
+# as an LEB128 varint. Short fields, whose length fits a single byte, are by far the
+# most common, so their headers are built up front.
+_KEY_HEADERS = tuple(bytes((_KEY, n)) for n in range(0x80))
+_VALUE_HEADERS = tuple(bytes((_VALUE, n)) for n in range(0x80))
+_TOMBSTONE_HEADERS = tuple(bytes((_TOMBSTONE, n)) for n in range(0x80))
+
+
+def _encode_varint(n: int) -> bytes:
+    """Encode the non-negative integer as an LEB128 varint."""
+    encoded = bytearray()
+    while n >= 0x80:
+        encoded.append(n & 0x7F | 0x80)
+        n >>= 7
+    encoded.append(n)
+    return bytes(encoded)
+
+
+def _decode_varint(buffer: "_Buffer", offset: int) -> tuple[int, int]:
+    """Decode the LEB128 varint at the offset of the buffer.
+
+    Returns the integer and the offset just past its end."""
+    n = 0
+    shift = 0
+    while True:
+        byte = buffer[offset]
+        offset += 1
+        n |= (byte & 0x7F) << shift
+        if byte < 0x80:
+            return n, offset
+        shift += 7
+
+
+def _varint_size(n: int) -> int:
+    """The size in bytes of the integer encoded as an LEB128 varint."""
+    return max(1, (n.bit_length() + 6) // 7)
+
+
+def _field_header(headers: tuple[bytes, ...], type_: int, length: int) -> bytes:
+    """Get the header of a field, using the prebuilt headers if its length allows."""
+    if length < 0x80:
+        return headers[length]
+    return bytes((type_,)) + _encode_varint(length)
+
+
 class ToyDBRecord:
     """Individual database record."""
 
-    key: bytes
-    value: bytes | None
-    tombstone: bool
-
     __slots__ = (
         "key",
         "value",
         "tombstone",
     )
 
+    def __init__(self, key: bytes, value: bytes | None, tombstone: bool):
+        self.key = key
+        self.value = value
+        self.tombstone = tombstone
+
+    def __repr__(self) -> str:
+        return (
+            f"{type(self).__name__}(key={self.key!r}, value={self.value!r}, "
+            f"tombstone={self.tombstone!r})"
+        )
+
+    def __eq__(self, other: object) -> bool:
+        if not isinstance(other, ToyDBRecord):
+            return NotImplemented
+        return (
+            self.key == other.key
+            and self.value == other.value
+            and self.tombstone == other.tombstone
+        )
+
     @property
     def size_in_bytes(self):
         """The size in bytes of this record if it were serialized."""
-        size_of_key = 2 + len(self.key)
-        size_of_value = 2 + len(self.value)
+        size_of_key = 1 + _varint_size(len(self.key)) + len(self.key)
+        if self.tombstone:
+            return size_of_key
+        size_of_value = 1 + _varint_size(len(self.value)) + len(self.value)
         return size_of_key + size_of_value
 
     def serialize(self) -> bytes:
         """Serialize this record to bytes."""
-        if not self.tombstone:
-            to_write = bytes()
-            to_write += bytes([ToyDBType.KEY])
-            serialized_key = self.key
-            try:
-                to_write += bytes([len(serialized_key)])
-            except ValueError:
-                raise ToyDBException(
-                    f"Key '{self.key}' is longer than the allowed 255 bytes."
-                )
-            to_write += serialized_key
-            to_write += bytes([ToyDBType.VALUE])
-            serialized_value = self.value
-            try:
-                to_write += bytes([len(serialized_value)])
-            except ValueError:
+        if self.tombstone:
+            return (
+                _field_header(_TOMBSTONE_HEADERS, _TOMBSTONE, len(self.key)) + self.key
+            )
+        return b"".join(
+            (
+                _field_header(_KEY_HEADERS, _KEY, len(self.key)),
+                self.key,
+                _field_header(_VALUE_HEADERS, _VALUE, len(self.value)),
+                self.value,
+            )
+        )
+
+    @classmethod
+    def deserialize_from_buffer(
+        cls, buffer: "_Buffer", offset: int
+    ) -> tuple[Self, int]:
+        """Deserialize the record starting at the offset of the buffer.
+
+        Returns the record and the offset just past its end."""
+        try:
+            type_ = buffer[offset]
+            length = buffer[offset + 1]
+            offset += 2
+            if length & 0x80:
+                length, offset = _decode_varint(buffer, offset - 1)
+            key = bytes(buffer[offset : offset + length])
+            offset += length
+            # Ordered by how common the types are, key/value pairs come first.
+            if type_ == _KEY:
+                if buffer[offset] != _VALUE:
+                    raise ToyDBException(
+                        f"Corrupt DB, type '{ToyDBType.VALUE}' expected after type '{ToyDBType.KEY}'."
+                    )
+                length = buffer[offset + 1]
+                offset += 2
+                if length & 0x80:
+                    length, offset = _decode_varint(buffer, offset - 1)
+                value = bytes(buffer[offset : offset + length])
+                offset += length
+                record = cls(key, value, False)
+            elif type_ == _TOMBSTONE:
+                record = cls(key, None, True)
+            elif type_ == _VALUE:
                 raise ToyDBException(
-                    f"Value '{self.value}' is longer than the allowed 255 bytes."
+                    f"Corrupt DB, type '{ToyDBType.VALUE}' without prior type '{ToyDBType.KEY}'."
                 )
-            to_write += serialized_value
-            return to_write
+            else:
+                raise ToyDBException(f"Corrupt DB, unknown type '{type_}'.")
+        except IndexError:
+            raise ToyDBException("Corrupt DB, unexpected end of data.")
+        if offset > len(buffer):
+            raise ToyDBException("Corrupt DB, unexpected end of data.")
+        return record, offset
+
+
+# Contents of a data file, either read into memory or mapped
+_Buffer = memoryview | mmap.mmap
+
+
+@contextlib.contextmanager
+def _open_data_file(
+    path: pathlib.Path, once: bool = False
+) -> Generator[_Buffer, None, None]:
+    """Open the whole data file at the path for parsing.
+
+    Larger data files are memory mapped so that scanning them doesn't copy them, the
+    mapping is indexed directly as slicing it already produces bytes. Where supported,
+    the kernel is told that the file is read sequentially so that it reads ahead more
+    aggressively. If the file is only going to be read once, e.g. because it is about
+    to be rewritten, its pages are dropped from the page cache afterwards so they
+    don't evict more useful ones."""
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        size = os.fstat(fd).st_size
+        if size < _MMAP_THRESHOLD:
+            if _HAS_FADVISE:
+                os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_SEQUENTIAL)
+            chunks = []
+            while size > 0 and (chunk := os.read(fd, size)):
+                chunks.append(chunk)
+                size -= len(chunk)
+            yield memoryview(chunks[0] if len(chunks) == 1 else b"".join(chunks))
         else:
-            to_write = bytes()
-            to_write += bytes([ToyDBType.TOMBSTONE])
-            serialized_key = self.key
-            try:
-                to_write += bytes([len(serialized_key)])
-            except ValueError:
-                raise ToyDBException(
-                    f"Key '{self.key}' is longer than the allowed 255 bytes."
-                )
-            to_write += serialized_key
-            return to_write
+            with mmap.mmap(fd, 0, access=mmap.ACCESS_READ) as mapping:
+                if _HAS_MADVISE:
+                    mapping.madvise(mmap.MADV_SEQUENTIAL)
+                yield mapping
+        if once and _HAS_FADVISE:
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+    finally:
+        os.close(fd)
 
-    @classmethod
-    async def deserialize(cls, file) -> Self | None:
-        key = None
-        while type_ := await file.read(1):
-            length = int.from_bytes(await file.read(1), byteorder="big")
-            match int.from_bytes(type_, byteorder="big"):
-                case ToyDBType.KEY:
-                    if key:
-                        raise ToyDBException(
-                            f"Corrupt DB, type '{ToyDBType.KEY}' after type '{key}'."
-                        )
-                    key = await file.read(length)
-                case ToyDBType.VALUE:
-                    if not key:
-                        raise ToyDBException(
-                            f"Corrupt DB, type '{ToyDBType.VALUE}' without prior type '{ToyDBType.KEY}'."
-                        )
-                    return ToyDBRecord(
-                        key=key,
-                        value=await file.read(length),
-                        tombstone=False,
-                    )
-                case ToyDBType.TOMBSTONE:
-                    return ToyDBRecord(
-                        key=await file.read(length), value=None, tombstone=True
-                    )
-                case other:
-                    raise ToyDBException(f"Corrupt DB, unknown type '{other}'.")
+
+def _iter_buffer(buffer: _Buffer) -> Generator[tuple[ToyDBRecord, int], None, None]:
+    """Parse the records of a data file's contents one after another.
+
+    Yields each record along with the offset it ends at. Data files that are still
+    empty don't have a format version yet."""
+    if not len(buffer):
+        return
+    if buffer[0] != _FORMAT_VERSION:
+        raise ToyDBException(f"Unsupported data file format version '{buffer[0]}'.")
+    offset = len(_FILE_HEADER)
+    if _fast is not None:
+        for key, value, end in _fast.parse_buffer(buffer, offset):
+            yield ToyDBRecord(key, value, value is None), end
+        return
+    while offset < len(buffer):
+        record, offset = ToyDBRecord.deserialize_from_buffer(buffer, offset)
+        yield record, offset
+
+
+def _parse_records(path: pathlib.Path, once: bool = False) -> list[ToyDBRecord]:
+    """Read the whole data file at the path in one go and parse all of its records.
+
+    This is synchronous on purpose, run it through `asyncio.to_thread` so that the
+    entire file costs a single executor dispatch instead of one per byte. Pass `once`
+    when the data file is about to be rewritten."""
+    with _open_data_file(path, once) as buffer:
+        return [record for record, _ in _iter_buffer(buffer)]
+
+
+# Byte offset and length of a value within its data file, None for tombstones
+_ValueLocation = tuple[int, int] | None
+
+
+def _value_location(record: ToyDBRecord, end: int) -> _ValueLocation:
+    """Get the location of the record's value given the offset the record ends at."""
+    if record.tombstone:
+        return None
+    return end - len(record.value), len(record.value)
+
+
+# Smallest and largest key of a data file, None if it is empty
+_KeyRange = tuple[bytes, bytes] | None
+
+
+def _key_range(keys: Iterable[bytes], key_range: _KeyRange = None) -> _KeyRange:
+    """Get the range spanned by the keys, widening the given key range if any."""
+    keys = list(keys)
+    if not keys:
+        return key_range
+    low, high = min(keys), max(keys)
+    if key_range is not None:
+        low, high = min(low, key_range[0]), max(high, key_range[1])
+    return low, high
+
+
+def _parse_value_locations(
+    path: pathlib.Path,
+) -> tuple[list[tuple[bytes, _ValueLocation]], int]:
+    """Read the whole data file at the path and return each record's value location.
+
+    Tombstones are included so that they can shadow older values of the key. Also
+    returns the size of the data file, which saves a separate stat."""
+    with _open_data_file(path) as buffer:
+        entries = [
+            (record.key, _value_location(record, end))
+            for record, end in _iter_buffer(buffer)
+        ]
+        return entries, len(buffer)
+
+
+def _migrate_data_file(path: pathlib.Path) -> None:
+    """Rewrite a data file in an older format in the current one.
+
+    Data files from before the format was versioned have one byte lengths, the
+    first version had two byte lengths."""
+    # Only the first byte is needed to tell whether the data file is up to date
+    with open(path, "rb") as file:
+        first = file.read(1)
+    if not first or first[0] == _FORMAT_VERSION:
+        return
+    data = path.read_bytes()
+    if data[0] == _FORMAT_VERSION_UINT16:
+        length_size, offset = 2, 1
+    else:
+        length_size, offset = 1, 0
+
+    def read_field(offset: int) -> tuple[int, bytes, int]:
+        start = offset + 1 + length_size
+        length = int.from_bytes(data[offset + 1 : start])
+        if start + length > len(data):
+            raise IndexError
+        return data[offset], data[start : start + length], start + length
+
+    parts = [_FILE_HEADER]
+    try:
+        while offset < len(data):
+            type_, key, offset = read_field(offset)
+            if type_ == _TOMBSTONE:
+                record = ToyDBRecord(key, None, True)
+            elif type_ == _KEY and data[offset] == _VALUE:
+                _, value, offset = read_field(offset)
+                record = ToyDBRecord(key, value, False)
+            else:
+                raise ToyDBException(f"Corrupt DB, unexpected type '{type_}'.")
+            parts.append(record.serialize())
+    except IndexError:
+        raise ToyDBException("Corrupt DB, unexpected end of data.")
+    # Temp files of compactions and merges are called tempdataN.db
+    temp_path = path.with_name(f"migrating{path.name}")
+    _write_all(temp_path, parts)
+    temp_path.replace(path)
+
+
+def _pread_cached(fd: int, length: int, offset: int) -> bytes | None:
+    """Read from the file descriptor only if that doesn't block, i.e. the data is cached.
+
+    Returns None if the data would have to be read from disk, or the platform or
+    file system doesn't support this."""
+    buffer = bytearray(length)
+    try:
+        read = os.preadv(fd, [buffer], offset, os.RWF_NOWAIT)
+    except OSError:
+        return None
+    if read != length:
+        return None
+    return bytes(buffer)
+
+
+def _write_all(path: pathlib.Path, parts: Iterable[bytes]) -> None:
+    """Write all parts to the file at the path, replacing its contents."""
+    with open(path, "wb") as file:
+        file.writelines(parts)
+
+
+def _append_all(file: BinaryIO, parts: Iterable[bytes]) -> None:
+    """Append all parts to the open file and flush them to the OS."""
+    file.writelines(parts)
+    file.flush()
+
+
+def _fsync_all(fds: Iterable[int], directory: pathlib.Path) -> None:
+    """Flush the files to disk along with the directory containing them."""
+    for fd in fds:
+        os.fsync(fd)
+    # New files also need their directory entry to be durable
+    if hasattr(os, "O_DIRECTORY"):
+        fd = os.open(directory, os.O_RDONLY | os.O_DIRECTORY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+
+def _write_bloom(path: pathlib.Path, bloom: BloomFilter, data_size: int) -> None:
+    """Persist the Bloom filter of a data file of the given size at the path."""
+    temp_path = path.with_name(f"temp{path.name}")
+    _write_all(temp_path, (_BLOOM_HEADER.pack(data_size), bloom.serialize()))
+    temp_path.replace(path)
+
+
+def _read_bloom(path: pathlib.Path, data_size: int) -> BloomFilter | None:
+    """Load the Bloom filter persisted at the path.
+
+    Returns None if there is none or it doesn't match the data file's size anymore."""
+    try:
+        data = path.read_bytes()
+    except FileNotFoundError:
         return None
+    if (
+        len(data) < _BLOOM_HEADER.size
+        or _BLOOM_HEADER.unpack_from(data)[0] != data_size
+    ):
+        return None
+    return BloomFilter.deserialize(data[_BLOOM_HEADER.size :])
+
+
+# A record buffered in the memtable along with its serialized form
+_MemtableEntry = tuple[ToyDBRecord, bytes]
+
+# Data file index, serialized records and the locations of their values
+_Chunk = tuple[int, list[bytes], list[tuple[bytes, _ValueLocation]]]
 
 
 class ToyDB:
-    def __init__(self, path: pathlib.Path | str):
+    __slots__ = (
+        "path",
+        "encoding",
+        "max_file_size",
+        "max_memtable_size",
+        "data_file_index",
+        "_data_files",
+        "_current_size",
+        "_index",
+        "_blooms",
+        "_current_keys",
+        "_key_ranges",
+        "_memtable",
+        "_memtable_bytes",
+        "_flushing",
+        "_flusher",
+        "_flush_requested",
+        "_write_lock",
+        "_lock_loop",
+        "_fds",
+        "_fd_users",
+        "_retired_fds",
+        "_append_file",
+        "_append_index",
+        "_unsynced",
+    )
+
+    def __init__(
+        self,
+        path: pathlib.Path | str,
+        max_file_size: int = DEFAULT_MAX_FILE_SIZE,
+    ):
         """Initialize ToyDB instance.
 
-        :param path: The path (i.e. directory) under which to save the data files."""
+        :param path: The path (i.e. directory) under which to save the data files.
+        :param max_file_size: The size in bytes after which to roll over to a new data
+            file."""
         self.path = path if isinstance(path, pathlib.Path) else pathlib.Path(path)
         if not self.path.exists():
             self.path.mkdir(parents=True)
@@ -126,9 +485,11 @@ class ToyDB:
             raise ToyDBException(f"Path '{self.path}' is not a directory.")
 
         self.encoding = "utf-8"
-        # Artificially low to make things pertaining to multiple files easier to test
-        self.max_file_size = 255
+        self.max_file_size = max_file_size
 
+        # Paths of the data files by index, they're needed all over the place and
+        # building them over and over again adds up.
+        self._data_files: list[pathlib.Path] = []
         self.data_file_index = 0
         while True:
             if not self.file.exists():
@@ -139,9 +500,63 @@ class ToyDB:
                 break
             self.data_file_index += 1
 
-        # In-memory cache for each file that maps keys to the respective byte offset
-        # TODO: Pre-warm the cache on class startup.
-        self.cache: dict[pathlib.Path, dict[str, int]] = defaultdict(dict)
+        # In-memory hash index that maps each live key to the data file index, byte
+        # offset and length of its newest value. Deleted keys are simply absent, so
+        # `get` takes a single lookup and a single read regardless of the data files.
+        self._index: dict[bytes, tuple[int, int, int]] = {}
+        # Bloom filter of the keys in each data file before the current one, used to
+        # tell whether older data files might still hold a value that a tombstone has
+        # to shadow.
+        self._blooms: list[BloomFilter] = []
+        # Keys in the current data file, its Bloom filter is built from them once it is
+        # rolled over and the number of keys is known.
+        self._current_keys: set[bytes] = set()
+        # Range of the keys in each data file, which narrows that down even further as
+        # data files are written sorted by key.
+        self._key_ranges: list[_KeyRange] = []
+        # Build the index, this is synchronous as __init__ can't be awaited anyway.
+        size = 0
+        for index, data_file in enumerate(self.files):
+            _migrate_data_file(data_file)
+            entries, size = _parse_value_locations(data_file)
+            self._update_index(index, entries)
+            keys = {key for key, _ in entries}
+            if index < self.data_file_index:
+                bloom = _read_bloom(self._get_bloom_file(index), size)
+                self._blooms.append(bloom or self._build_bloom(keys))
+            else:
+                self._current_keys = keys
+            self._key_ranges.append(_key_range(keys))
+        # Size of the current data file, tracked in memory to save a stat per write
+        self._current_size = size
+
+        # Writes are buffered in the memtable and flushed to the data files in one go
+        # once it holds about a data file's worth of records.
+        self.max_memtable_size = self.max_file_size
+        self._memtable: dict[bytes, _MemtableEntry] = {}
+        self._memtable_bytes = 0
+        # The memtable that is currently being flushed, `get` still has to consult it
+        self._flushing: dict[bytes, _MemtableEntry] = {}
+        # Background flush, started by writes as there might be no running loop yet.
+        # It flushes once the flush interval passed or as soon as it is requested.
+        self._flusher: asyncio.Task[None] | None = None
+        self._flush_requested = asyncio.Event()
+        # Serializes everything that writes to the data files, see `_lock`
+        self._write_lock = asyncio.Lock()
+        self._lock_loop: asyncio.AbstractEventLoop | None = None
+
+        # Read-only file descriptors of the data files, opened lazily by `get` and
+        # kept in least recently used order so that the oldest can be closed once
+        # there are too many.
+        self._fds: OrderedDict[int, int] = OrderedDict()
+        # Reads in flight per file descriptor, those can't be closed before they're done
+        self._fd_users: dict[int, int] = {}
+        self._retired_fds: set[int] = set()
+        # The data file being appended to is kept open across flushes
+        self._append_file: BinaryIO | None = None
+        self._append_index = 0
+        # Indices of the data files written to since the last `sync`
+        self._unsynced: set[int] = set()
 
     @property
     def file(self) -> pathlib.Path:
@@ -159,154 +574,561 @@ class ToyDB:
         return (self._get_data_file(i) for i in range(self.data_file_index, -1, -1))
 
     def _get_data_file(self, index: int) -> pathlib.Path:
-        return self.path / f"data{index}.db"
+        data_files = self._data_files
+        while len(data_files) <= index:
+            data_files.append(self.path / f"data{len(data_files)}.db")
+        return data_files[index]
 
     def _get_temp_data_file(self, index: int) -> pathlib.Path:
         return self.path / f"tempdata{index}.db"
 
+    def _get_bloom_file(self, index: int) -> pathlib.Path:
+        return self.path / f"data{index}.bloom"
+
+    def _build_bloom(self, keys: Collection[bytes]) -> BloomFilter:
+        """Build a Bloom filter for a data file holding the keys."""
+        bloom = BloomFilter.for_capacity(len(keys))
+        bloom.add_many(keys)
+        return bloom
+
+    def _may_contain(self, index: int, key: bytes) -> bool:
+        """Whether the data file at the index might contain a record for the key.
+
+        Only works for the data files before the current one."""
+        key_range = self._key_ranges[index]
+        return (
+            key_range is not None
+            and key_range[0] <= key <= key_range[1]
+            and key in self._blooms[index]
+        )
+
+    async def _save_bloom(self, index: int, data_size: int) -> None:
+        """Persist the Bloom filter of the data file at the index."""
+        await asyncio.to_thread(
+            _write_bloom, self._get_bloom_file(index), self._blooms[index], data_size
+        )
+
+    @contextlib.contextmanager
+    def _use_fd(self, index: int) -> Generator[int, None, None]:
+        """Use the cached read-only file descriptor for the data file at the index.
+
+        The file descriptor stays open while in use, even if the data file is
+        replaced or the file descriptor gets evicted from the cache in the meantime."""
+        fd = self._fds.get(index)
+        if fd is None:
+            fd = self._fds[index] = os.open(self._get_data_file(index), os.O_RDONLY)
+            if len(self._fds) > _MAX_OPEN_FDS:
+                self._retire_fd(self._fds.popitem(last=False)[1])
+        else:
+            self._fds.move_to_end(index)
+        self._fd_users[fd] = self._fd_users.get(fd, 0) + 1
+        try:
+            yield fd
+        finally:
+            users = self._fd_users.pop(fd) - 1
+            if users:
+                self._fd_users[fd] = users
+            elif fd in self._retired_fds:
+                self._retired_fds.remove(fd)
+                os.close(fd)
+
+    def _retire_fd(self, fd: int) -> None:
+        """Close the file descriptor once it isn't in use anymore."""
+        if fd in self._fd_users:
+            self._retired_fds.add(fd)
+        else:
+            os.close(fd)
+
+    @property
+    def _lock(self) -> asyncio.Lock:
+        """Get the lock that serializes everything that writes to the data files.
+
+        Locks are bound to the event loop they're first used in, a new one is created
+        for each event loop this instance is used in."""
+        loop = asyncio.get_running_loop()
+        if self._lock_loop is not loop:
+            self._lock_loop = loop
+            self._write_lock = asyncio.Lock()
+        return self._write_lock
+
+    def _get_append_file(self, index: int) -> BinaryIO:
+        """Get the file to append to the data file at the index with.
+
+        Only the file of a single data file is kept open, as appends only ever go to
+        the current data file after rolling over."""
+        if self._append_file is not None and self._append_index != index:
+            self._close_append_file()
+        if self._append_file is None:
+            self._append_file = open(self._get_data_file(index), "ab")
+            self._append_index = index
+        return self._append_file
+
+    def _close_append_file(self) -> None:
+        append_file, self._append_file = self._append_file, None
+        if append_file is not None:
+            append_file.close()
+
+    def _close_fd(self, index: int) -> None:
+        """Close the cached files of the data file, if there are any."""
+        fd = self._fds.pop(index, None)
+        if fd is not None:
+            self._retire_fd(fd)
+        if self._append_index == index:
+            self._close_append_file()
+
+    async def close(self) -> None:
+        """Flush the memtable and release the resources held by this instance."""
+        if self._flusher is not None:
+            self._flush_requested.set()
+            await self._flusher
+        try:
+            async with self._lock:
+                await self._flush()
+        finally:
+            for index in list(self._fds):
+                self._close_fd(index)
+            self._close_append_file()
+
     async def drop(self) -> None:
         """Drops the entire database."""
-        for file in self.files:
+        async with self._lock:
+            self._memtable.clear()
+            self._memtable_bytes = 0
+            self._drop_files()
+
+    def _drop_files(self) -> None:
+        for index, file in enumerate(self.files):
+            self._close_fd(index)
             file.unlink(missing_ok=True)
-            # If we are dropping the DB we don't care about cache misses.
-            self.cache.pop(file, None)
+            self._get_bloom_file(index).unlink(missing_ok=True)
+        self._index.clear()
+        self._blooms = []
+        self._current_keys = set()
+        self._key_ranges = [None]
+        self._unsynced.clear()
+        self.data_file_index = 0
+        self._current_size = 0
+        self.file.touch()
 
     async def iterate(
         self, index: int | None = None
-    ) -> Generator[ToyDBRecord, None, None]:
-        files = self.files if not index else [list(self.files)[index]]
-        for path in files:
-            async with aiofiles.open(path, "br") as file:
-                while record := await ToyDBRecord.deserialize(file):
-                    yield record
-
-    async def merge(self):
-        """Merge file segments."""
-        await self.compact_all()
-        new_cache: dict[pathlib.Path, dict[str, int]] = defaultdict(dict)
-        key_record_mapping = {}
-        index = 0
-        async for record in self.iterate():
-            # This would be the size in bytes of the current data file if it were to be written to disk.
-            current_size = sum((r.size_in_bytes for r in key_record_mapping.values()))
-            size_with_record = current_size + record.size_in_bytes
-            if record.key in key_record_mapping:
-                size_with_record -= key_record_mapping[record.key].size_in_bytes
-            if size_with_record >= self.max_file_size:
-                async with aiofiles.open(self._get_temp_data_file(index), "ba") as file:
-                    for key, record_to_write in key_record_mapping.items():
-                        new_cache[self._get_data_file(index)][
-                            key.decode(self.encoding)
-                        ] = await file.tell()
-                        await file.write(record_to_write.serialize())
-                index += 1
-                key_record_mapping = {record.key: record}
-            else:
-                key_record_mapping[record.key] = record
-        # Write the last data file out
-        async with aiofiles.open(self._get_temp_data_file(index), "ba") as file:
-            for key, record_to_write in key_record_mapping.items():
-                new_cache[self._get_data_file(index)][
-                    key.decode(self.encoding)
-                ] = await file.tell()
-                await file.write(record_to_write.serialize())
-        await self.drop()
-        for i in range(index + 1):
+    ) -> AsyncGenerator[ToyDBRecord, None]:
+        """Iterate over all records in the data files, oldest first.
+
+        :param index: Only iterate over the data file at this index."""
+        indices = range(self.data_file_index + 1) if index is None else [index]
+        for i, data_index in enumerate(indices):
+            # Records only make it into the data files when the memtable is flushed,
+            # and the data files must not be parsed while they're being written to.
+            async with self._lock:
+                if i == 0:
+                    await self._flush()
+                records = await asyncio.to_thread(
+                    _parse_records, self._get_data_file(data_index)
+                )
+            for record in records:
+                yield record
+
+    async def merge(self) -> None:
+        """Merge all data files into as few as possible.
+
+        Only the newest value of each key is kept, deleted keys are dropped entirely."""
+        async with self._lock:
+            await self._flush()
+            await self._merge()
+
+    async def _merge(self) -> None:
+        # Newer records win. As all data files are merged, there is nothing older left
+        # for tombstones to shadow, so they are dropped along with the deleted values.
+        live_records: dict[bytes, ToyDBRecord] = {}
+        for path in self.files:
+            for record in await asyncio.to_thread(_parse_records, path, True):
+                if record.tombstone:
+                    live_records.pop(record.key, None)
+                else:
+                    live_records[record.key] = record
+        # The data files are written sorted by key, so that each covers a key range of
+        # its own.
+        segments: list[list[ToyDBRecord]] = [[]]
+        size = len(_FILE_HEADER)
+        for key in sorted(live_records):
+            record = live_records[key]
+            if segments[-1] and size + record.size_in_bytes > self.max_file_size:
+                segments.append([])
+                size = len(_FILE_HEADER)
+            segments[-1].append(record)
+            size += record.size_in_bytes
+        new_locations: list[dict[bytes, _ValueLocation]] = []
+        sizes: list[int] = []
+        for index, segment in enumerate(segments):
+            locations, size = await self._write_segment(
+                self._get_temp_data_file(index), segment
+            )
+            new_locations.append(locations)
+            sizes.append(size)
+        self._drop_files()
+        for i in range(len(segments)):
             self._get_temp_data_file(i).rename(self._get_data_file(i))
-        self.data_file_index = index
-        self.cache = new_cache
+            self._unsynced.add(i)
+        self.data_file_index = len(segments) - 1
+        self._current_size = size
+        self._blooms = []
+        self._key_ranges = []
+        # The whole index has to be rebuilt before anything else gets to run, reads
+        # would miss the keys of the segments that aren't indexed yet otherwise.
+        for i, locations in enumerate(new_locations):
+            self._update_index(i, locations.items())
+            self._blooms.append(self._build_bloom(locations))
+            self._key_ranges.append(_key_range(locations))
+        self._blooms.pop()
+        self._current_keys = set(new_locations[-1])
+        for i, data_size in enumerate(sizes[:-1]):
+            await self._save_bloom(i, data_size)
+
+    async def _write_segment(
+        self, path: pathlib.Path, records: Iterable[ToyDBRecord]
+    ) -> tuple[dict[bytes, _ValueLocation], int]:
+        """Write the records to a new data file at the path in a single go.
+
+        Returns the location of each record's value in the new file and its size in
+        bytes."""
+        records = list(records)
+        parts = [record.serialize() for record in records]
+        # Data files without any records stay empty, without a format version
+        start = len(_FILE_HEADER) if parts else 0
+        ends = list(itertools.accumulate(map(len, parts), initial=start))
+        await asyncio.to_thread(_write_all, path, [_FILE_HEADER[:start], *parts])
+        locations = {
+            record.key: _value_location(record, end)
+            for record, end in zip(records, ends[1:])
+        }
+        return locations, ends[-1]
+
+    def _update_index(
+        self, index: int, locations: Iterable[tuple[bytes, _ValueLocation]]
+    ) -> None:
+        """Point the index at the data file for the given values, in order."""
+        for key, location in locations:
+            if location is None:
+                self._index.pop(key, None)
+            else:
+                self._index[key] = (index, *location)
 
     async def compact_all(self) -> None:
         """Compact all data files."""
-        await asyncio.gather(
-            *[self.compact(index=i) for i in range(self.data_file_index)]
-        )
+        async with self._lock:
+            await self._flush()
+            await self._compact_all()
+
+    async def _compact_all(self) -> None:
+        if self.data_file_index == 0:
+            return
+        # Compactions are bound by disk I/O, running more than a couple at once just
+        # has them compete for the disk.
+        semaphore = asyncio.Semaphore(_MAX_CONCURRENT_COMPACTIONS)
+
+        async def compact(index: int) -> None:
+            async with semaphore:
+                await self._compact(index)
+
+        await asyncio.gather(*(compact(i) for i in range(self.data_file_index)))
 
     async def compact(self, index: int | None = None) -> None:
         """Compact the data file at the index, defaults to the current data file."""
-        if not index:
+        async with self._lock:
+            await self._flush()
+            await self._compact(index)
+
+    async def _compact(self, index: int | None = None) -> None:
+        if index is None:
             index = self.data_file_index
         values: dict[bytes, bytes] = {}
         tombstones: set[bytes] = set()
-        current_key = None
         file_to_compact = self._get_data_file(index)
-        async with aiofiles.open(file_to_compact, "br") as file:
-            while type_ := await file.read(1):
-                length = int.from_bytes(await file.read(1), byteorder="big")
-                match int.from_bytes(type_, byteorder="big"):
-                    case ToyDBType.KEY:
-                        if current_key:
-                            raise ToyDBException(
-                                f"Corrupt DB, type '{ToyDBType.KEY}' after type '{current_key}'."
-                            )
-                        current_key = await file.read(length)
-                    case ToyDBType.VALUE:
-                        if not current_key:
-                            raise ToyDBException(
-                                f"Corrupt DB, type '{ToyDBType.VALUE}' without prior type '{0}'."
-                            )
-                        values[current_key] = await file.read(length)
-                        if current_key in tombstones:
-                            tombstones.remove(current_key)
-                        # Reset current key so we can read the next value
-                        current_key = None
-                    case ToyDBType.TOMBSTONE:
-                        tombstone_key = await file.read(length)
-                        del values[tombstone_key]
-                        tombstones.add(tombstone_key)
-                    case other:
-                        raise ToyDBException(f"Corrupt DB, unknown type '{other}'.")
-        file_to_compact.unlink()
-        file_to_compact.touch()
-        self.cache[file_to_compact] = {}
-        for key, value in values.items():
-            await self.set(key.decode(self.encoding), value.decode(self.encoding))
-        for key in tombstones:
-            await self.delete(key.decode(self.encoding))
-
-    async def get(self, key: str) -> str | None:
+        for record in await asyncio.to_thread(_parse_records, file_to_compact, True):
+            if record.tombstone:
+                values.pop(record.key, None)
+                tombstones.add(record.key)
+            else:
+                values[record.key] = record.value
+                tombstones.discard(record.key)
+        # Tombstones only need to be kept around while older data files might still
+        # contain a value for their key.
+        records = [
+            ToyDBRecord(key=key, value=value, tombstone=False)
+            for key, value in values.items()
+        ]
+        records.extend(
+            ToyDBRecord(key=key, value=None, tombstone=True)
+            for key in tombstones
+            if any(self._may_contain(i, key) for i in range(index))
+        )
+        records.sort(key=lambda record: record.key)
+        temp_file = self._get_temp_data_file(index)
+        locations, size = await self._write_segment(temp_file, records)
+        self._close_fd(index)
+        temp_file.replace(file_to_compact)
+        self._unsynced.add(index)
+        if index == self.data_file_index:
+            self._current_size = size
+        # Only the values whose newest version lives in the compacted file moved. The
+        # index has to point into the new file before anything else gets to run.
+        for key, location in locations.items():
+            if location is not None and self._index.get(key, (None,))[0] == index:
+                self._index[key] = (index, *location)
+        self._key_ranges[index] = _key_range(locations)
+        if index == self.data_file_index:
+            self._current_keys = set(locations)
+        else:
+            self._blooms[index] = self._build_bloom(locations)
+            await self._save_bloom(index, size)
+
+    def _encode_key(self, key: str | bytes) -> bytes:
+        """Encode the key as it is stored, keys that are bytes already are kept."""
+        return key.encode(self.encoding) if isinstance(key, str) else bytes(key)
+
+    async def get(self, key: str | bytes) -> str | None:
         """Get the value behind the given key or None if it isn't present."""
-        for current_file in self.files_reversed:
-            byte_offset = self.cache[current_file].get(key, None)
-            if byte_offset is not None:
-                async with aiofiles.open(current_file, "br") as file:
-                    await file.seek(byte_offset)
-                    record = await ToyDBRecord.deserialize(file)
-                    if record.tombstone:
-                        return None
-                    return record.value.decode(self.encoding)
-        return None
+        # Keys are only ever handled as bytes internally, encode them once up front.
+        serialized_key = self._encode_key(key)
+        entry = self._memtable.get(serialized_key)
+        if entry is None:
+            entry = self._flushing.get(serialized_key)
+        if entry is not None:
+            record = entry[0]
+            if record.tombstone:
+                return None
+            return record.value.decode(self.encoding)
+        location = self._index.get(serialized_key)
+        if location is None:
+            return None
+        index, offset, length = location
+        if not length:
+            return ""
+        with self._use_fd(index) as fd:
+            # Values in the page cache can be read right away, reading them in a
+            # worker thread would take an order of magnitude longer than the read.
+            value = _pread_cached(fd, length, offset) if _HAS_RWF_NOWAIT else None
+            if value is None:
+                value = await asyncio.to_thread(os.pread, fd, length, offset)
+        if len(value) != length:
+            raise ToyDBException("Corrupt DB, unexpected end of data.")
+        return value.decode(self.encoding)
 
-    async def set(self, key: str, value: str) -> None:
+    async def set(self, key: str | bytes, value: str) -> None:
         """Set the given key to the given value."""
         record = ToyDBRecord(
-            key=key.encode(self.encoding),
+            key=self._encode_key(key),
             value=value.encode(self.encoding),
             tombstone=False,
         )
-        serialized_record = record.serialize()
-        if (
-            self.file.exists()
-            and (os.path.getsize(self.file) + len(serialized_record))
-            > self.max_file_size
-        ):
-            self.data_file_index += 1
-        byte_offset = os.path.getsize(self.file) if self.file.exists() else 0
-        async with aiofiles.open(self.file, "ba") as file:
-            await file.write(serialized_record)
-        self.cache[self.file][key] = byte_offset
+        await self._buffer(record)
 
-    async def delete(self, key: str) -> None:
+    async def delete(self, key: str | bytes) -> None:
         """Delete the given key."""
-        record = ToyDBRecord(key=key.encode(self.encoding), value=None, tombstone=True)
+        record = ToyDBRecord(
+            key=self._encode_key(key),
+            value=None,
+            tombstone=True,
+        )
+        await self._buffer(record)
+
+    async def flush(self) -> None:
+        """Write the records buffered in the memtable out to the data files."""
+        async with self._lock:
+            await self._flush()
+
+    async def sync(self) -> None:
+        """Flush the memtable and make sure that all data is durably stored on disk.
+
+        Flushing only hands the records to the OS, use this when they have to survive
+        a crash of the machine as well."""
+        async with self._lock:
+            await self._flush()
+            with contextlib.ExitStack() as stack:
+                fds = [
+                    stack.enter_context(self._use_fd(index))
+                    for index in sorted(self._unsynced)
+                ]
+                await asyncio.to_thread(_fsync_all, fds, self.path)
+            self._unsynced.clear()
+
+    async def _buffer(self, record: ToyDBRecord) -> None:
+        """Buffer the record in the memtable, flushing it in the background when full."""
         serialized_record = record.serialize()
-        if (
-            self.file.exists()
-            and (os.path.getsize(self.file) + len(serialized_record))
-            > self.max_file_size
-        ):
-            self.data_file_index += 1
-        byte_offset = os.path.getsize(self.file) if self.file.exists() else 0
-        async with aiofiles.open(self.file, "ba") as file:
-            await file.write(serialized_record)
-        self.cache[self.file][key] = byte_offset
+        previous = self._memtable.get(record.key)
+        if previous is not None:
+            self._memtable_bytes -= len(previous[1])
+        self._memtable[record.key] = (record, serialized_record)
+        self._memtable_bytes += len(serialized_record)
+        if self._flusher is None:
+            # Like locks, events are bound to the event loop they're used in
+            self._flush_requested = asyncio.Event()
+            self._flusher = asyncio.create_task(self._flush_later())
+        if self._memtable_bytes < self.max_memtable_size:
+            return
+        # Apply backpressure by waiting for the memtable to be flushed before buffering
+        # even more.
+        self._flush_requested.set()
+        # Cancelling a writer must not cancel the flush it happens to wait for
+        await asyncio.shield(self._flusher)
+        if self._memtable_bytes >= self.max_memtable_size:
+            # The background flush failed and put the records back, retrying it here
+            # surfaces the error to the writer.
+            await self.flush()
+
+    async def _flush_later(self) -> None:
+        """Flush the memtable once the flush interval passed or a flush is requested.
+
+        Errors are logged rather than raised, nothing might be waiting for this task.
+        The records stay in the memtable, so the next write schedules another flush."""
+        try:
+            with contextlib.suppress(TimeoutError):
+                await asyncio.wait_for(self._flush_requested.wait(), _FLUSH_INTERVAL)
+            self._flush_requested.clear()
+            await self.flush()
+        except asyncio.CancelledError:
+            # Most likely the event loop is shutting down, like at the end of
+            # `asyncio.run`. The records would be lost without flushing them right
+            # away, unless a flush is underway already.
+            if not self._lock.locked():
+                self._flush_now()
+            raise
+        except Exception:
+            _logger.exception("Flushing the memtable in the background failed.")
+        finally:
+            if self._flusher is asyncio.current_task():
+                self._flusher = None
+
+    async def _flush(self) -> None:
+        if not self._memtable:
+            return
+        self._flushing, self._memtable = self._memtable, {}
+        self._memtable_bytes = 0
+        try:
+            # Sorting makes each flushed batch a sorted run of keys
+            await self._append(sorted(self._flushing.items()))
+        except asyncio.CancelledError:
+            # The records were written all the same, see `_append`
+            raise
+        except BaseException:
+            # Put the records back, unless they have been overwritten in the meantime
+            self._memtable = self._flushing | self._memtable
+            self._memtable_bytes = sum(len(s) for _, s in self._memtable.values())
+            raise
+        finally:
+            self._flushing = {}
+
+    async def _append(self, entries: Iterable[tuple[bytes, _MemtableEntry]]) -> None:
+        """Append the entries to the data files."""
+        chunks, sizes = self._split_into_chunks(entries)
+        # The writes can't be taken back once they're running in their thread, so
+        # even if this is cancelled they're waited for and the index is updated, only
+        # then is the cancellation passed on.
+        write = asyncio.get_running_loop().run_in_executor(
+            None, self._write_chunks, [(i, parts) for i, parts, _ in chunks]
+        )
+        cancelled = False
+        while True:
+            try:
+                await asyncio.shield(write)
+                break
+            except asyncio.CancelledError:
+                if write.cancelled():
+                    raise
+                cancelled = True
+        self._index_chunks(chunks, sizes[-1])
+        if cancelled:
+            raise asyncio.CancelledError
+        # Data files that were rolled over are complete, persist their Bloom filters
+        # so that they don't have to be rebuilt on startup.
+        for (i, _, _), data_size in zip(chunks[:-1], sizes):
+            await self._save_bloom(i, data_size)
+
+    def _flush_now(self) -> None:
+        """Flush the memtable right away, blocking the event loop.
+
+        For when awaiting isn't an option anymore, like while the event loop shuts
+        down."""
+        if not self._memtable:
+            return
+        chunks, sizes = self._split_into_chunks(sorted(self._memtable.items()))
+        self._write_chunks([(i, parts) for i, parts, _ in chunks])
+        self._memtable = {}
+        self._memtable_bytes = 0
+        self._index_chunks(chunks, sizes[-1])
+        for (i, _, _), data_size in zip(chunks[:-1], sizes):
+            _write_bloom(self._get_bloom_file(i), self._blooms[i], data_size)
+
+    def _split_into_chunks(
+        self, entries: Iterable[tuple[bytes, _MemtableEntry]]
+    ) -> tuple[list[_Chunk], list[int]]:
+        """Group the entries by the data file they're appended to.
+
+        Rolls over to a new data file whenever the current one would grow past the
+        maximum size. Records are grouped per data file so that each file costs a
+        single write. Also returns the size each data file ends up with."""
+        index = self.data_file_index
+        size = self._current_size
+        chunks: list[_Chunk] = [(index, [], [])]
+        sizes = []
+        for key, (record, serialized_record) in entries:
+            if (
+                size > len(_FILE_HEADER)
+                and size + len(serialized_record) > self.max_file_size
+            ):
+                sizes.append(size)
+                index += 1
+                size = 0
+                chunks.append((index, [], []))
+            if size == 0:
+                chunks[-1][1].append(_FILE_HEADER)
+                size = len(_FILE_HEADER)
+            size += len(serialized_record)
+            chunks[-1][1].append(serialized_record)
+            chunks[-1][2].append((key, _value_location(record, size)))
+        sizes.append(size)
+        return chunks, sizes
+
+    def _index_chunks(self, chunks: list[_Chunk], size: int) -> None:
+        """Point the index at the chunks written to the data files.
+
+        :param size: The size of the last data file written to."""
+        index = chunks[-1][0]
+        self.data_file_index = index
+        self._current_size = size
+        for i, _, locations in chunks:
+            self._update_index(i, locations)
+            if i == len(self._key_ranges):
+                self._key_ranges.append(None)
+            self._key_ranges[i] = _key_range(
+                (key for key, _ in locations), self._key_ranges[i]
+            )
+            self._current_keys.update(key for key, _ in locations)
+            if i < index:
+                self._blooms.append(self._build_bloom(self._current_keys))
+                self._current_keys = set()
+
+    def _write_chunks(self, chunks: Iterable[tuple[int, list[bytes]]]) -> None:
+        """Append the serialized records to the data files at the indices.
+
+        Either all of them are written or none are, on errors whatever made it to the
+        data files is cut off again so that the records can simply be retried."""
+        written: list[int] = []
+        try:
+            for i, parts in chunks:
+                if parts:
+                    written.append(i)
+                    _append_all(self._get_append_file(i), parts)
+                    self._unsynced.add(i)
+        except BaseException:
+            # Part of the records might still be buffered, closing tries to write them
+            # out but they're cut off right after anyway.
+            with contextlib.suppress(OSError):
+                self._close_append_file()
+            for i in written:
+                if i == self.data_file_index:
+                    os.truncate(self._get_data_file(i), self._current_size)
+                else:
+                    self._get_data_file(i).unlink(missing_ok=True)
+            raise
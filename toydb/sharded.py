@@ -0,0 +1,94 @@
+"""Sharded database implementation."""
+
+import asyncio
+import hashlib
+import pathlib
+from typing import AsyncGenerator
+
+from toydb.db import DEFAULT_MAX_FILE_SIZE, ToyDB, ToyDBException, ToyDBRecord
+
+
+class ShardedToyDB:
+    """ToyDB split into independent shards by the hash of the keys.
+
+    Every shard is a ToyDB of its own in a subdirectory, with its own data files,
+    index, memtable and lock, so that operations on different shards don't wait for
+    each other."""
+
+    __slots__ = ("path", "shards")
+
+    def __init__(
+        self,
+        path: pathlib.Path | str,
+        shard_count: int = 4,
+        max_file_size: int = DEFAULT_MAX_FILE_SIZE,
+    ):
+        """Initialize ShardedToyDB instance.
+
+        :param path: The path (i.e. directory) under which to save the shards.
+        :param shard_count: The number of shards, can't change once data is written.
+        :param max_file_size: The size in bytes after which to roll over to a new data
+            file, per shard."""
+        if shard_count < 1:
+            raise ToyDBException(f"Shard count must be at least 1, not {shard_count}.")
+        self.path = path if isinstance(path, pathlib.Path) else pathlib.Path(path)
+        if self.path.is_dir():
+            # Keys would be looked up in the wrong shards otherwise
+            existing = sum(1 for shard in self.path.glob("shard*") if shard.is_dir())
+            if existing and existing != shard_count:
+                raise ToyDBException(
+                    f"Path '{self.path}' holds {existing} shards, not {shard_count}."
+                )
+        self.shards = [
+            ToyDB(self.path / f"shard{i}", max_file_size=max_file_size)
+            for i in range(shard_count)
+        ]
+
+    def _get_shard(self, key: str | bytes) -> ToyDB:
+        # Keys are routed by exactly the bytes the shards store them as
+        digest = hashlib.blake2b(
+            self.shards[0]._encode_key(key), digest_size=8
+        ).digest()
+        return self.shards[int.from_bytes(digest) % len(self.shards)]
+
+    async def get(self, key: str | bytes) -> str | None:
+        """Get the value behind the given key or None if it isn't present."""
+        return await self._get_shard(key).get(key)
+
+    async def set(self, key: str | bytes, value: str) -> None:
+        """Set the given key to the given value."""
+        await self._get_shard(key).set(key, value)
+
+    async def delete(self, key: str | bytes) -> None:
+        """Delete the given key."""
+        await self._get_shard(key).delete(key)
+
+    async def iterate(self) -> AsyncGenerator[ToyDBRecord, None]:
+        """Iterate over all records in the data files, shard by shard."""
+        for shard in self.shards:
+            async for record in shard.iterate():
+                yield record
+
+    async def flush(self) -> None:
+        """Write the records buffered in the memtables out to the data files."""
+        await asyncio.gather(*(shard.flush() for shard in self.shards))
+
+    async def sync(self) -> None:
+        """Make sure that all data is durably stored on disk."""
+        await asyncio.gather(*(shard.sync() for shard in self.shards))
+
+    async def merge(self) -> None:
+        """Merge the data files of each shard."""
+        await asyncio.gather(*(shard.merge() for shard in self.shards))
+
+    async def compact_all(self) -> None:
+        """Compact all data files of each shard."""
+        await asyncio.gather(*(shard.compact_all() for shard in self.shards))
+
+    async def drop(self) -> None:
+        """Drops the entire database."""
+        await asyncio.gather(*(shard.drop() for shard in self.shards))
+
+    async def close(self) -> None:
+        """Flush the memtables and release the resources held by the shards."""
+        await asyncio.gather(*(shard.close() for shard in self.shards))
@@ -0,0 +1,57 @@
+import pytest
+
+from toydb.bloom import BloomFilter
+
+
+def test_bloom_no_false_negatives():
+    bloom = BloomFilter.for_capacity(1000)
+    keys = [str(i).encode() for i in range(1000)]
+    for key in keys:
+        bloom.add(key)
+    assert all(key in bloom for key in keys)
+
+
+def test_bloom_false_positive_rate():
+    bloom = BloomFilter.for_capacity(1000, false_positive_rate=0.01)
+    for i in range(1000):
+        bloom.add(str(i).encode())
+    false_positives = sum(str(i).encode() in bloom for i in range(1000, 11000))
+    assert false_positives < 300
+
+
+def test_bloom_serialize():
+    bloom = BloomFilter.for_capacity(10)
+    bloom.add(b"key")
+    deserialized = BloomFilter.deserialize(bloom.serialize())
+    assert (deserialized.m, deserialized.k) == (bloom.m, bloom.k)
+    assert deserialized.bits == bloom.bits
+    assert b"key" in deserialized
+
+
+def test_bloom_compiled_matches_python(monkeypatch):
+    """Persisted filters have to be readable with and without the compiled version."""
+    pytest.importorskip("toydb._fast")
+    keys = [str(i).encode() for i in range(1000)]
+    compiled = BloomFilter.for_capacity(1000)
+    for key in keys:
+        compiled.add(key)
+    monkeypatch.setattr("toydb.bloom._fast", None)
+    python = BloomFilter.for_capacity(1000)
+    for key in keys:
+        python.add(key)
+    assert compiled.bits == python.bits
+
+
+@pytest.mark.parametrize("compiled", [True, False])
+def test_bloom_add_many(monkeypatch, compiled):
+    if compiled:
+        pytest.importorskip("toydb._fast")
+    else:
+        monkeypatch.setattr("toydb.bloom._fast", None)
+    keys = [str(i).encode() for i in range(1000)]
+    one_by_one = BloomFilter.for_capacity(1000)
+    for key in keys:
+        one_by_one.add(key)
+    bulk = BloomFilter.for_capacity(1000)
+    bulk.add_many(iter(keys))
+    assert bulk.bits == one_by_one.bits
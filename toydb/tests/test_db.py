@@ -1,14 +1,17 @@
 import asyncio
 import os
+import time
 
 import pytest
 
-from toydb.db import ToyDB, ToyDBRecord
+from toydb import db as db_module
+from toydb.db import ToyDB, ToyDBException, ToyDBRecord, _iter_buffer
 
 
 @pytest.fixture
 def db(tmp_path):
-    return ToyDB(tmp_path)
+    # Artificially low to make things pertaining to multiple files easier to test
+    return ToyDB(tmp_path, max_file_size=255)
 
 
 def test_db_files_reversed(db):
@@ -26,6 +29,54 @@ async def test_db_set_and_get(db):
     assert await db.get("key") == "value"
 
 
+@pytest.mark.asyncio
+async def test_db_bytes_keys(db):
+    await db.set(b"key", "value")
+    assert await db.get("key") == "value"
+    await db.set("k\u00e9y", "value")
+    assert await db.get("k\u00e9y".encode()) == "value"
+    assert await db.get(bytearray(b"key")) == "value"
+    await db.flush()
+    await db.delete(b"key")
+    assert await db.get("key") is None
+
+
+@pytest.mark.asyncio
+async def test_db_memtable(db):
+    await db.set("key", "value")
+    await db.set("deleted", "value")
+    await db.delete("deleted")
+    # Nothing has been written to disk yet, but everything is readable.
+    assert os.path.getsize(db.file) == 0
+    assert await db.get("key") == "value"
+    assert await db.get("deleted") is None
+    await db.flush()
+    assert os.path.getsize(db.file) > 0
+    assert await db.get("key") == "value"
+    assert await db.get("deleted") is None
+
+
+@pytest.mark.asyncio
+async def test_db_empty_value(db):
+    await db.set("key", "")
+    await db.set("other", "value")
+    await db.flush()
+    assert await db.get("key") == ""
+    assert await ToyDB(db.path).get("key") == ""
+
+
+@pytest.mark.asyncio
+async def test_db_set_long(db):
+    # Lengths are varints, so there is no upper bound for keys and values
+    await db.set("k" * 200, "v" * 70000)
+    await db.set("key", "v" * 128)
+    await db.delete("k" * 200)
+    await db.flush()
+    assert await db.get("k" * 200) is None
+    assert await db.get("key") == "v" * 128
+    assert await ToyDB(db.path).get("key") == "v" * 128
+
+
 @pytest.mark.asyncio
 async def test_db_duplicate_add(db):
     await db.set("key", "value")
@@ -40,6 +91,187 @@ async def test_db_delete(db):
     assert await db.get("key") is None
 
 
+@pytest.mark.asyncio
+async def test_db_reopen(db):
+    await db.set("key", "value")
+    await db.set("deleted", "value")
+    await db.delete("deleted")
+    await db.flush()
+    reopened = ToyDB(db.path)
+    assert await reopened.get("key") == "value"
+    assert await reopened.get("deleted") is None
+
+
+@pytest.mark.asyncio
+async def test_db_drop(db):
+    for i in range(100):
+        await db.set(str(i), str(i))
+    await db.drop()
+    assert len(list(db.files)) == 1
+    assert await db.get("0") is None
+    await db.set("key", "value")
+    assert await db.get("key") == "value"
+    assert os.path.getsize(db.file) == db._current_size
+
+
+@pytest.mark.asyncio
+async def test_db_fd_cache(db, monkeypatch):
+    monkeypatch.setattr("toydb.db._MAX_OPEN_FDS", 2)
+    for i in range(100):
+        await db.set(str(i), str(i))
+    await db.flush()
+    assert db.data_file_index >= 2
+    for i in range(100):
+        assert await db.get(str(i)) == str(i)
+    assert len(db._fds) == 2
+    # File descriptors in use are only closed once they are released
+    with db._use_fd(0) as fd:
+        db._close_fd(0)
+        os.fstat(fd)
+    with pytest.raises(OSError):
+        os.fstat(fd)
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("nowait", [True, False])
+async def test_db_get_read_path(db, monkeypatch, nowait):
+    """Values are read right away if cached or in a worker thread otherwise."""
+    monkeypatch.setattr(
+        "toydb.db._HAS_RWF_NOWAIT", nowait and hasattr(os, "RWF_NOWAIT")
+    )
+    await db.set("key", "value")
+    await db.set("empty", "")
+    await db.flush()
+    assert await db.get("key") == "value"
+    assert await db.get("empty") == ""
+
+
+@pytest.mark.asyncio
+async def test_db_memtable_flushed_in_background(db):
+    await db.set("key", "value")
+    assert os.path.getsize(db.file) == 0
+    await asyncio.sleep(0.2)
+    assert os.path.getsize(db.file) > 0
+    assert await db.get("key") == "value"
+
+
+@pytest.mark.asyncio
+async def test_db_background_flush_error(db, monkeypatch, caplog):
+    append_all = db_module._append_all
+
+    def failing_append_all(*args):
+        monkeypatch.setattr(db_module, "_append_all", append_all)
+        raise OSError("Disk hiccup")
+
+    monkeypatch.setattr(db_module, "_append_all", failing_append_all)
+    await db.set("a", "value")
+    await asyncio.sleep(0.2)
+    assert "Flushing the memtable in the background failed." in caplog.text
+    assert os.path.getsize(db.file) == 0
+    # The next write schedules another flush, which takes the records along
+    await db.set("b", "value")
+    await asyncio.sleep(0.2)
+    assert os.path.getsize(db.file) > 0
+    assert not db._memtable
+    await db.close()
+
+
+@pytest.mark.asyncio
+async def test_db_flush_error_after_partial_write(db, tmp_path, monkeypatch):
+    """Records written before a flush failed are cut off again and retried."""
+    append_all = db_module._append_all
+    calls = 0
+
+    def failing_append_all(*args):
+        nonlocal calls
+        calls += 1
+        if calls == 2:
+            raise OSError("No space left on device")
+        append_all(*args)
+
+    # Keep everything in the memtable for a single flush that rolls over
+    db.max_memtable_size = 4096
+    for i in range(30):
+        await db.set(str(i), f"value{i}")
+    monkeypatch.setattr(db_module, "_append_all", failing_append_all)
+    with pytest.raises(OSError):
+        await db.flush()
+    assert db.data_file_index == 0
+    assert os.path.getsize(db.file) == 0
+    monkeypatch.setattr(db_module, "_append_all", append_all)
+    await db.flush()
+    await db.close()
+    reopened = ToyDB(tmp_path, max_file_size=255)
+    for i in range(30):
+        assert await reopened.get(str(i)) == f"value{i}"
+
+
+def _slow_append_all(monkeypatch):
+    append_all = db_module._append_all
+
+    def slow_append_all(*args):
+        time.sleep(0.05)
+        append_all(*args)
+
+    monkeypatch.setattr(db_module, "_append_all", slow_append_all)
+
+
+@pytest.mark.asyncio
+async def test_db_cancelled_writer(db, tmp_path, monkeypatch):
+    """Cancelling a writer waiting for the memtable to be flushed loses nothing."""
+    _slow_append_all(monkeypatch)
+    await db.set("small", "x")
+    writer = asyncio.create_task(db.set("big", "y" * 300))
+    await asyncio.sleep(0.02)
+    writer.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await writer
+    await db.set("after", "z")
+    await db.close()
+    reopened = ToyDB(tmp_path, max_file_size=255)
+    assert await reopened.get("small") == "x"
+    assert await reopened.get("big") == "y" * 300
+    assert await reopened.get("after") == "z"
+
+
+@pytest.mark.asyncio
+async def test_db_cancelled_flush(db, tmp_path, monkeypatch):
+    """Cancelling a flush midway still leaves the index in line with the data files."""
+    _slow_append_all(monkeypatch)
+    for i in range(30):
+        await db.set(str(i), str(i))
+    flush = asyncio.create_task(db.flush())
+    await asyncio.sleep(0.02)
+    flush.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await flush
+    assert not db._memtable
+    assert await db.get("29") == "29"
+    await db.set("after", "value")
+    await db.close()
+    reopened = ToyDB(tmp_path, max_file_size=255)
+    assert await reopened.get("0") == "0"
+    assert await reopened.get("after") == "value"
+
+
+@pytest.mark.asyncio
+async def test_db_sync(db):
+    await db.set("key", "value")
+    await db.sync()
+    assert not db._unsynced
+    assert os.path.getsize(db.file) > 0
+    assert await ToyDB(db.path).get("key") == "value"
+
+
+@pytest.mark.asyncio
+async def test_db_close(db):
+    await db.set("key", "value")
+    assert await db.get("key") == "value"
+    await db.close()
+    assert not db._fds
+    assert await ToyDB(db.path).get("key") == "value"
+
+
 @pytest.mark.asyncio
 async def test_multiple_data_files(db):
     await db.set("first_key", "first_value")
@@ -54,12 +286,28 @@ async def test_multiple_data_files(db):
     assert await db.get("last_key") == "last_value"
 
 
+@pytest.mark.asyncio
+async def test_concurrent_writes(db):
+    await asyncio.gather(*(db.set(str(i), str(i * 2)) for i in range(100)))
+    await db.delete("0")
+    await db.flush()
+    # Batched writes still have to respect the maximum data file size
+    assert len(list(db.files)) > 1
+    for file in db.files:
+        assert os.path.getsize(file) <= db.max_file_size
+    assert await db.get("0") is None
+    for i in range(1, 100):
+        assert await db.get(str(i)) == str(i * 2)
+
+
 @pytest.mark.asyncio
 async def test_merge(db):
     await db.set("first_key", "first_value")
     # Fill the DB enough that it has to create a second data file
     for i in range(100):
         await db.set("0", str(i * 2))
+        # Overwrites are coalesced in the memtable, flush to have them hit the disk
+        await db.flush()
     await db.set("last_key", "last_value")
     # Assert that there are now at least 2 data files
     data_files_before = len(list(db.files))
@@ -76,11 +324,70 @@ async def test_merge(db):
     assert await db.get("last_key") == "last_value"
 
 
+@pytest.mark.asyncio
+async def test_merge_with_deletes(db):
+    for i in range(50):
+        await db.set(str(i), str(i * 2))
+    for i in range(0, 50, 2):
+        await db.delete(str(i))
+    await db.merge()
+    for i in range(50):
+        assert await db.get(str(i)) == (None if i % 2 == 0 else str(i * 2))
+
+
+@pytest.mark.asyncio
+async def test_merge_keeps_newest_records_only(db):
+    for i in range(50):
+        await db.set(str(i), str(i))
+        await db.flush()
+    for i in range(50):
+        await db.set(str(i), str(i * 2))
+        await db.flush()
+    await db.delete("0")
+    await db.merge()
+    records = [record async for record in db.iterate()]
+    assert not any(record.tombstone for record in records)
+    assert sorted(record.key for record in records) == sorted(
+        str(i).encode() for i in range(1, 50)
+    )
+    assert await db.get("1") == "2"
+    for i in range(db.data_file_index + 1):
+        keys = [record.key async for record in db.iterate(index=i)]
+        assert keys == sorted(keys)
+        assert db._key_ranges[i] == (keys[0], keys[-1])
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("operation", ["merge", "compact_all"])
+async def test_get_during_rewrite(db, monkeypatch, operation):
+    """Reads running while data files are rewritten see the values all along."""
+    write_bloom = db_module._write_bloom
+
+    def slow_write_bloom(*args):
+        time.sleep(0.01)
+        write_bloom(*args)
+
+    monkeypatch.setattr(db_module, "_write_bloom", slow_write_bloom)
+    for i in range(50):
+        await db.set(f"k{i:03}", f"val{i}")
+        await db.flush()
+    for i in range(0, 50, 2):
+        await db.delete(f"k{i:03}")
+    await db.flush()
+    rewrite = asyncio.create_task(getattr(db, operation)())
+    while not rewrite.done():
+        for i in range(1, 50, 2):
+            assert await db.get(f"k{i:03}") == f"val{i}"
+        await asyncio.sleep(0)
+    await rewrite
+
+
 @pytest.mark.asyncio
 async def test_compact(db):
     await db.set("deleted", "")
     await db.set("present", "value")
     await db.delete("deleted")
+    await db.flush()
     size_before_compact = os.path.getsize(db.file)
     await db.compact()
     size_after_compact = os.path.getsize(db.file)
@@ -89,27 +396,155 @@ async def test_compact(db):
     assert await db.get("deleted") is None
 
 
+@pytest.mark.asyncio
+async def test_compact_keeps_tombstones_for_older_files(db):
+    await db.set("deleted", "value")
+    for i in range(100):
+        await db.set(str(i), str(i))
+    await db.delete("deleted")
+    assert db.data_file_index > 0
+    await db.compact()
+    assert await db.get("deleted") is None
+    assert await db.get("99") == "99"
+
+
+@pytest.mark.asyncio
+async def test_compact_drops_tombstones_not_in_older_files(db):
+    for i in range(100):
+        await db.set(str(i), str(i))
+    await db.flush()
+    index = db.data_file_index
+    assert index > 0
+    await db.set("never written before", "value")
+    await db.delete("never written before")
+    await db.delete("0")
+    await db.flush()
+    await db.compact(index=index)
+    keys = [record.key async for record in db.iterate(index=index)]
+    assert b"never written before" not in keys
+    assert b"0" in keys
+    assert await db.get("0") is None
+
+
+@pytest.mark.asyncio
+async def test_db_reopen_large_data_file(tmp_path):
+    """Data files above the mmap threshold are mapped instead of read."""
+    records = [
+        ToyDBRecord(key=b"%d" % i, value=b"x" * 100, tombstone=False)
+        for i in range(100)
+    ]
+    records.append(ToyDBRecord(key=b"0", value=None, tombstone=True))
+    (tmp_path / "data0.db").write_bytes(
+        b"\x03" + b"".join(r.serialize() for r in records)
+    )
+    db = ToyDB(tmp_path)
+    assert await db.get("0") is None
+    assert await db.get("99") == "x" * 100
+    assert [record async for record in db.iterate()] == records
+
+
+@pytest.mark.asyncio
+async def test_db_migrate_unversioned_data_file(tmp_path):
+    """Data files from before the format was versioned are migrated on startup."""
+    (tmp_path / "data0.db").write_bytes(
+        b"\x00\x03key\x01\x05value\x00\x05other\x01\x00\x02\x03key"
+    )
+    db = ToyDB(tmp_path)
+    assert (tmp_path / "data0.db").read_bytes()[0] == 3
+    assert await db.get("key") is None
+    assert await db.get("other") == ""
+
+
+@pytest.mark.asyncio
+async def test_db_migrate_uint16_data_file(tmp_path):
+    """Data files with two byte lengths are migrated on startup."""
+    (tmp_path / "data0.db").write_bytes(b"\x01\x00\x00\x03key\x01\x01\x00" + b"v" * 256)
+    db = ToyDB(tmp_path)
+    assert (tmp_path / "data0.db").read_bytes()[0] == 3
+    assert await db.get("key") == "v" * 256
+
+
+@pytest.mark.asyncio
+async def test_db_reopen_loads_blooms(db, tmp_path):
+    for i in range(100):
+        await db.set(str(i), str(i))
+    await db.close()
+    assert db._get_bloom_file(0).exists()
+    # The current data file gets its Bloom filter once it is rolled over
+    assert not db._get_bloom_file(db.data_file_index).exists()
+    reopened = ToyDB(tmp_path)
+    assert len(reopened._blooms) == reopened.data_file_index
+    for i in range(100):
+        key = str(i).encode()
+        assert key in reopened._current_keys or any(
+            key in bloom for bloom in reopened._blooms
+        )
+
+
+@pytest.mark.asyncio
+async def test_db_bloom_sized_for_keys(tmp_path):
+    db = ToyDB(tmp_path)
+    await db.set("key", "value")
+    await db.close()
+    assert not db._get_bloom_file(0).exists()
+    for i in range(1000):
+        await db.set(f"{i:04}", "value")
+    db.max_file_size = 4096
+    await db.merge()
+    assert db.data_file_index > 0
+    # Filters hold about ten bits per key of their data file
+    for i in range(db.data_file_index):
+        keys = len([record async for record in db.iterate(index=i)])
+        assert os.path.getsize(db._get_bloom_file(i)) < keys * 2 + 32
+    await db.close()
+
+
+@pytest.mark.asyncio
+async def test_compact_first_file(db):
+    await db.set("key", "old value")
+    await db.flush()
+    await db.set("key", "value")
+    # Flushed batches are sorted, keep "key" ahead of the other keys
+    await db.flush()
+    for i in range(100):
+        await db.set(str(i), str(i))
+    await db.flush()
+    size_before_compact = os.path.getsize(db._get_data_file(0))
+    current_size_before_compact = os.path.getsize(db.file)
+    await db.compact(index=0)
+    assert os.path.getsize(db._get_data_file(0)) < size_before_compact
+    assert os.path.getsize(db.file) == current_size_before_compact
+    assert await db.get("key") == "value"
+
+
+@pytest.mark.asyncio
+async def test_iterate_index(db):
+    await db.set("key", "value")
+    await db.flush()
+    for i in range(100):
+        await db.set(str(i), str(i))
+    records = [record async for record in db.iterate(index=0)]
+    assert records[0] == ToyDBRecord(key=b"key", value=b"value", tombstone=False)
+    assert ToyDBRecord(key=b"99", value=b"99", tombstone=False) not in records
+
+
 @pytest.mark.asyncio
 async def test_iterate(db):
     await db.set("1", "value")
     await db.set("2", "another")
     await db.delete("1")
+    # The delete replaced the value in the memtable before it was ever written out
     expected = [
         ToyDBRecord(
             key=b"1",
-            value=b"value",
-            tombstone=False,
+            value=None,
+            tombstone=True,
         ),
         ToyDBRecord(
             key=b"2",
             value=b"another",
             tombstone=False,
         ),
-        ToyDBRecord(
-            key=b"1",
-            value=None,
-            tombstone=True,
-        ),
     ]
 
     assert [value async for value in db.iterate()] == expected
@@ -118,12 +553,71 @@ async def test_iterate(db):
 @pytest.mark.asyncio
 async def test_size_in_bytes(db):
     await db.set("key", "value")
+    await db.flush()
+    # Data files start with the version of their format
     assert (
         os.path.getsize(db.file)
-        == ToyDBRecord(key=b"key", value=b"value", tombstone=False).size_in_bytes
+        == 1 + ToyDBRecord(key=b"key", value=b"value", tombstone=False).size_in_bytes
     )
 
 
+def test_record_deserialize_truncated():
+    serialized = ToyDBRecord(key=b"key", value=b"v" * 200, tombstone=False).serialize()
+    with pytest.raises(ToyDBException):
+        ToyDBRecord.deserialize_from_buffer(memoryview(serialized[:-1]), 0)
+    # Cut off in the middle of the value's varint length
+    with pytest.raises(ToyDBException):
+        ToyDBRecord.deserialize_from_buffer(memoryview(serialized[:6]), 0)
+
+
+def test_parse_compiled_matches_python(monkeypatch):
+    pytest.importorskip("toydb._fast")
+    records = [
+        ToyDBRecord(key=b"key", value=b"v" * 200, tombstone=False),
+        ToyDBRecord(key=b"key", value=None, tombstone=True),
+        ToyDBRecord(key=b"", value=b"", tombstone=False),
+    ]
+    buffer = memoryview(b"\x03" + b"".join(r.serialize() for r in records))
+    compiled = list(_iter_buffer(buffer))
+    with pytest.raises(ToyDBException):
+        list(_iter_buffer(buffer[:-1]))
+    monkeypatch.setattr("toydb.db._fast", None)
+    assert list(_iter_buffer(buffer)) == compiled
+    assert [record for record, _ in compiled] == records
+
+
+def test_record_serialize_varint_lengths():
+    for length in (0, 1, 127, 128, 16383, 16384):
+        record = ToyDBRecord(key=b"k" * length, value=b"v" * length, tombstone=False)
+        serialized = record.serialize()
+        assert len(serialized) == record.size_in_bytes
+        buffer = memoryview(serialized)
+        assert ToyDBRecord.deserialize_from_buffer(buffer, 0) == (record, len(buffer))
+
+
+def test_db_across_event_loops(tmp_path):
+    """Writes aren't lost when each runs in an event loop of its own."""
+    db = ToyDB(tmp_path, max_file_size=255)
+    for i in range(100):
+        asyncio.run(db.set(str(i), str(i)))
+    asyncio.run(db.delete("0"))
+    reopened = ToyDB(tmp_path, max_file_size=255)
+    assert asyncio.run(reopened.get("0")) is None
+    for i in range(1, 100):
+        assert asyncio.run(reopened.get(str(i))) == str(i)
+
+
+def test_db_flushed_on_shutdown(tmp_path):
+    """Records still in the memtable are flushed when the event loop shuts down."""
+
+    async def main():
+        db = ToyDB(tmp_path)
+        await db.set("key", "value")
+
+    asyncio.run(main())
+    assert asyncio.run(ToyDB(tmp_path).get("key")) == "value"
+
+
 @pytest.mark.skip
 def test_performance(db, benchmark):
     """WIP attempt at some performance testing."""
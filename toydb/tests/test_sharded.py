@@ -0,0 +1,53 @@
+import asyncio
+
+import pytest
+
+from toydb import ShardedToyDB, ToyDBException
+
+
+@pytest.fixture
+def db(tmp_path):
+    return ShardedToyDB(tmp_path, shard_count=4, max_file_size=255)
+
+
+@pytest.mark.asyncio
+async def test_sharded_db(db):
+    await asyncio.gather(*(db.set(str(i), str(i * 2)) for i in range(100)))
+    await db.delete("0")
+    assert await db.get("0") is None
+    for i in range(1, 100):
+        assert await db.get(str(i)) == str(i * 2)
+    # Keys are spread across all shards
+    await db.flush()
+    assert all(shard._index for shard in db.shards)
+
+
+@pytest.mark.asyncio
+async def test_sharded_db_reopen(db, tmp_path):
+    for i in range(100):
+        await db.set(str(i), str(i))
+    await db.close()
+    reopened = ShardedToyDB(tmp_path, shard_count=4)
+    for i in range(100):
+        assert await reopened.get(str(i)) == str(i)
+    with pytest.raises(ToyDBException):
+        ShardedToyDB(tmp_path, shard_count=2)
+
+
+def test_sharded_db_shard_count(tmp_path):
+    with pytest.raises(ToyDBException):
+        ShardedToyDB(tmp_path, shard_count=0)
+
+
+@pytest.mark.asyncio
+async def test_sharded_db_merge_and_drop(db):
+    for i in range(100):
+        await db.set(str(i), str(i))
+    await db.delete("1")
+    await db.merge()
+    assert await db.get("1") is None
+    assert await db.get("2") == "2"
+    records = [record async for record in db.iterate()]
+    assert len(records) == 99
+    await db.drop()
+    assert await db.get("2") is None